@@ -1,13 +1,18 @@
+import hashlib
 import json
 import os
 import re
 import shutil
 import subprocess
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
+import requests
 import torch
+import torch.nn.functional as F
 from cog import BasePredictor, Input, Path
 from diffusers import (
     DDIMScheduler,
@@ -16,26 +21,21 @@ from diffusers import (
     EulerAncestralDiscreteScheduler,
     EulerDiscreteScheduler,
     HeunDiscreteScheduler,
+    LCMScheduler,
     PNDMScheduler,
     StableDiffusionXLPipeline,
     StableDiffusionXLImg2ImgPipeline,
     StableDiffusionXLInpaintPipeline,
 )
-from diffusers.models.attention_processor import LoRAAttnProcessor2_0
-from diffusers.pipelines.stable_diffusion.safety_checker import (
-    StableDiffusionSafetyChecker,
-)
 from diffusers.utils import load_image
+from diffusers.utils.torch_utils import is_compiled_module
 from safetensors import safe_open
-from safetensors.torch import load_file
-from transformers import CLIPImageProcessor
+from torchao.quantization import apply_dynamic_quant, swap_conv2d_1x1_to_linear
+from torchao.quantization.quant_primitives import dynamically_quantize_per_channel
 
 import json
-import requests
-from io import BytesIO
-import tarfile
 import torch
-from PIL import Image
+from PIL import Image, ImageOps
 import shutil
 import math
 
@@ -44,6 +44,48 @@ from dataset_and_utils import TokenEmbeddingsHandler
 
 MODEL_NAME = "SG161222/RealVisXL_V2.0"
 MODEL_CACHE = "model-cache"
+LORA_CACHE = "/tmp/lora-cache"
+LORA_CACHE_SIZE = 8
+PROMPT_CACHE_SIZE = 32
+# int8 dynamic quantization of the Unet Linears, full Unet fine-tunes are
+# re-quantized when loaded
+QUANTIZE_UNET = True
+QUANT_SKIP_NAMES = {"to_q", "to_k", "to_v", "to_qkv", "to_kv"}
+QUANT_SKIP_SHAPES = {
+    (1280, 640),
+    (1920, 1280),
+    (1920, 640),
+    (2048, 1280),
+    (2048, 2560),
+    (2560, 1280),
+    (256, 128),
+    (2816, 1280),
+    (320, 640),
+    (512, 1536),
+    (512, 256),
+    (640, 1280),
+    (640, 1920),
+    (640, 320),
+    (640, 5120),
+    (640, 640),
+    (960, 320),
+    (960, 640),
+}
+# Tensors batched as [uncond, cond] that truncate_cfg splits
+CFG_TENSOR_INPUTS = ["prompt_embeds", "add_text_embeds", "add_time_ids"]
+# Shapes are snapped to these buckets so the compiled Unet's guards keep
+# hitting; run with TORCH_LOGS="recompiles" to check nothing recompiles
+SIZE_BUCKETS = (512, 768, 1024, 1280)
+BATCH_BUCKETS = (1, 2, 4)
+# (width, height, batch) compiled during setup; other buckets still compile
+# on their first request
+WARMUP_SHAPES = [
+    (1024, 1024, 1),
+    (1024, 1024, 2),
+    (1024, 1024, 4),
+    (768, 1024, 1),
+    (1024, 768, 1),
+]
 
 
 class KarrasDPM:
@@ -51,6 +93,8 @@ class KarrasDPM:
         return DPMSolverMultistepScheduler.from_config(config, use_karras_sigmas=True)
 
 
+LCM_STEPS = 4
+
 SCHEDULERS = {
     "DDIM": DDIMScheduler,
     "DPMSolverMultistep": DPMSolverMultistepScheduler,
@@ -58,6 +102,7 @@ SCHEDULERS = {
     "KarrasDPM": KarrasDPM,
     "K_EULER_ANCESTRAL": EulerAncestralDiscreteScheduler,
     "K_EULER": EulerDiscreteScheduler,
+    "LCM": LCMScheduler,
     "PNDM": PNDMScheduler,
 }
 
@@ -70,14 +115,160 @@ def download_weights(url, dest):
     print("downloading took: ", time.time() - start)
 
 
+def load_file_pinned(path, device="cuda"):
+    # Reading on CPU and copying from pinned memory is much faster than
+    # safe_open(device="cuda"), which serializes page faults with the copies
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+    tensors = {}
+    with safe_open(path, framework="pt", device="cpu") as f:
+        for k in f.keys():
+            tensors[k] = f.get_tensor(k).pin_memory().to(device, non_blocking=True)
+    torch.cuda.synchronize()
+    return tensors
+
+
+def lora_target(attn, lora_name):
+    # Returns the Linear (relative to attn) and rows that a LoRA layer of the
+    # training attn processors adapts, once fuse_qkv_projections() has packed
+    # q/k/v into to_qkv (self-attention) or k/v into to_kv (cross-attention)
+    if lora_name == "to_out_lora":
+        return "to_out.0", slice(None)
+
+    proj = lora_name[: -len("_lora")]
+    if not getattr(attn, "fused_projections", False):
+        return proj, slice(None)
+    if attn.is_cross_attention:
+        if proj == "to_q":
+            return "to_q", slice(None)
+        fused, projs = "to_kv", ["to_k", "to_v"]
+    else:
+        fused, projs = "to_qkv", ["to_q", "to_k", "to_v"]
+
+    start = 0
+    for name in projs:
+        end = start + getattr(attn, name).out_features
+        if name == proj:
+            return fused, slice(start, end)
+        start = end
+
+
+@torch.no_grad()
+def refresh_fused_projections(unet):
+    # Rebuilds the fused q/k/v weights in place from the separate projections
+    # after those were overwritten, keeping the fused modules (and the
+    # compiled graph) intact
+    for module in unet.modules():
+        if not getattr(module, "fused_projections", False):
+            continue
+        if module.is_cross_attention:
+            fused, projs = module.to_kv, [module.to_k, module.to_v]
+        else:
+            fused, projs = module.to_qkv, [module.to_q, module.to_k, module.to_v]
+        fused.weight.copy_(torch.cat([p.weight for p in projs]))
+        if fused.bias is not None:
+            fused.bias.copy_(torch.cat([p.bias for p in projs]))
+
+
+def quantized_unet_params(unet, sd, params):
+    # Maps fine-tuned params onto the Unet's state_dict. Weights of Linears
+    # that apply_dynamic_quant() replaced are re-quantized into their int8
+    # buffer and scales, so they load in place like any other param
+    modules = dict(unet.named_modules())
+    new_params = {}
+    for k, v in params.items():
+        module_name, param_name = k.rsplit(".", 1)
+        module = modules.get(module_name)
+        if k not in sd and param_name == "weight" and hasattr(module, "W_int_repr_t"):
+            w_int, w_scales, _ = dynamically_quantize_per_channel(
+                v.to(module.W_scales.dtype), -128, 127, torch.int8
+            )
+            new_params[f"{module_name}.W_int_repr_t"] = w_int.contiguous().t()
+            new_params[f"{module_name}.W_scales"] = w_scales
+        else:
+            new_params[k] = v
+    return new_params
+
+
+def conv_filter_fn(mod, *args):
+    return (
+        isinstance(mod, torch.nn.Conv2d)
+        and mod.kernel_size == (1, 1)
+        and 128 in [mod.in_channels, mod.out_channels]
+    )
+
+
+def dynamic_quant_filter_fn(mod, fqn):
+    # LoRAs are merged into the attention projections, so they stay fp16
+    if fqn.rsplit(".", 1)[-1] in QUANT_SKIP_NAMES or fqn.endswith("to_out.0"):
+        return False
+    # int8 matmuls are slower than fp16 for these small shapes
+    return (
+        isinstance(mod, torch.nn.Linear)
+        and mod.in_features > 16
+        and (mod.in_features, mod.out_features) not in QUANT_SKIP_SHAPES
+    )
+
+
+def cfg_cutoff(guidance_end, num_steps):
+    # index of the last guided step, negative when no step is guided
+    return int(guidance_end * num_steps) - 1
+
+
+def truncate_cfg(guidance_end):
+    # Drops classifier-free guidance after the first guidance_end fraction of
+    # steps; with guidance_scale 0 diffusers skips the negative prompt pass
+    def callback(pipe, step_index, timestep, callback_kwargs):
+        cutoff = cfg_cutoff(guidance_end, pipe.num_timesteps)
+        if step_index == cutoff and pipe.do_classifier_free_guidance:
+            pipe._guidance_scale = 0.0
+            # keep the conditional half of the batched tensors
+            for k, v in callback_kwargs.items():
+                if v is not None:
+                    callback_kwargs[k] = v.chunk(2)[-1]
+        return callback_kwargs
+
+    return callback
+
+
+def save_image(image, path, quality):
+    # PNG level 1 encodes several times faster than the default level 6 for
+    # slightly larger files, method 0 is the fastest WebP encoder
+    if path.endswith(".png"):
+        image.save(path, compress_level=1)
+    elif path.endswith(".webp"):
+        image.save(path, quality=quality, method=0)
+    else:
+        image.save(path, quality=quality)
+
+
+def _bucket(width, height):
+    def nearest(x):
+        return min(SIZE_BUCKETS, key=lambda b: abs(b - x))
+
+    return nearest(width), nearest(height)
+
+
+def _bucket_batch(num_outputs):
+    return next(b for b in BATCH_BUCKETS if b >= num_outputs)
+
+
 class Predictor(BasePredictor):
     def load_trained_weights(self, weights_url, pipe):
-        # Get the TAR archive content
-        weights_tar_data = requests.get(weights_url).content
-        with tarfile.open(fileobj=BytesIO(weights_tar_data), mode='r') as tar_ref:
-            tar_ref.extractall("trained-model")
+        # Drop the previous fine-tune so weights don't stack across requests
+        self.unload_trained_weights(pipe)
+        # cached prompts were encoded with the previous token embeddings
+        self.prompt_cache.clear()
+
+        # state_dict keys of a compiled module carry an `_orig_mod.` prefix
+        unet = pipe.unet._orig_mod if is_compiled_module(pipe.unet) else pipe.unet
+
+        local_weights_cache = self.fetch_trained_weights(weights_url)
 
-        local_weights_cache = "./trained-model"
         # load UNET
         print("Loading fine-tuned model")
         self.is_lora = False
@@ -87,60 +278,46 @@ class Predictor(BasePredictor):
             print("Does not have Unet. Assume we are using LoRA")
             self.is_lora = True
 
+        sd = unet.state_dict()
         if not self.is_lora:
             print("Loading Unet")
 
-            new_unet_params = load_file(
-                os.path.join(local_weights_cache, "unet.safetensors")
+            new_unet_params = quantized_unet_params(
+                unet,
+                sd,
+                load_file_pinned(os.path.join(local_weights_cache, "unet.safetensors")),
             )
-            sd = pipe.unet.state_dict()
+            self.save_base_unet_params(sd, new_unet_params.keys())
             sd.update(new_unet_params)
-            pipe.unet.load_state_dict(sd)
+            unet.load_state_dict(sd)
+            refresh_fused_projections(unet)
 
         else:
             print("Loading Unet LoRA")
 
-            unet = pipe.unet
-
-            tensors = load_file(os.path.join(
+            tensors = load_file_pinned(os.path.join(
                 local_weights_cache, "lora.safetensors"))
 
-            unet = pipe.unet
-            unet_lora_attn_procs = {}
-            name_rank_map = {}
+            # resolve each target Linear once here instead of on every merge
+            modules = dict(unet.named_modules())
+            # keys look like `<attn>.processor.to_q_lora.up.weight`
             for tk, tv in tensors.items():
-                # up is N, d
-                if tk.endswith("up.weight"):
-                    proc_name = ".".join(tk.split(".")[:-3])
-                    r = tv.shape[1]
-                    name_rank_map[proc_name] = r
-
-            for name, attn_processor in unet.attn_processors.items():
-                cross_attention_dim = (
-                    None
-                    if name.endswith("attn1.processor")
-                    else unet.config.cross_attention_dim
-                )
-                if name.startswith("mid_block"):
-                    hidden_size = unet.config.block_out_channels[-1]
-                elif name.startswith("up_blocks"):
-                    block_id = int(name[len("up_blocks.")])
-                    hidden_size = list(reversed(unet.config.block_out_channels))[
-                        block_id
-                    ]
-                elif name.startswith("down_blocks"):
-                    block_id = int(name[len("down_blocks.")])
-                    hidden_size = unet.config.block_out_channels[block_id]
-
-                module = LoRAAttnProcessor2_0(
-                    hidden_size=hidden_size,
-                    cross_attention_dim=cross_attention_dim,
-                    rank=name_rank_map[name],
-                )
-                unet_lora_attn_procs[name] = module.to("cuda")
-
-            unet.set_attn_processor(unet_lora_attn_procs)
-            unet.load_state_dict(tensors, strict=False)
+                proc_name, lora_name, direction, _ = tk.rsplit(".", 3)
+                attn_name = proc_name[: -len(".processor")]
+                if f"{proc_name}.{lora_name}" not in self.lora_layers:
+                    target, rows = lora_target(modules[attn_name], lora_name)
+                    linear_name = f"{attn_name}.{target}"
+                    self.lora_layers[f"{proc_name}.{lora_name}"] = {
+                        "linear": modules[linear_name],
+                        "weight_name": f"{linear_name}.weight",
+                        "rows": rows,
+                    }
+                self.lora_layers[f"{proc_name}.{lora_name}"][direction] = tv
+
+            self.save_base_unet_params(
+                sd, {lora["weight_name"] for lora in self.lora_layers.values()}
+            )
+            # merged by merge_lora() once the scale is known
 
         # load text
         handler = TokenEmbeddingsHandler(
@@ -157,29 +334,268 @@ class Predictor(BasePredictor):
 
         self.tuned_model = True
 
+    def fetch_trained_weights(self, weights_url):
+        url_hash = hashlib.sha256(weights_url.encode()).hexdigest()[:16]
+        local_weights_cache = os.path.join(LORA_CACHE, url_hash)
+        # written last, so it also marks a complete extraction
+        etag_path = os.path.join(local_weights_cache, "etag")
+
+        try:
+            response = requests.head(weights_url, allow_redirects=True, timeout=10)
+            etag = response.headers.get("ETag", "")
+        except requests.RequestException:
+            etag = None
+
+        if os.path.exists(etag_path):
+            with open(etag_path, "r") as f:
+                cached_etag = f.read()
+            if not etag or etag == cached_etag:
+                print("Using cached trained weights: ", local_weights_cache)
+                os.utime(local_weights_cache)
+                return local_weights_cache
+
+        # Clear stale files, e.g. a unet.safetensors left by a previous archive
+        shutil.rmtree(local_weights_cache, ignore_errors=True)
+        os.makedirs(LORA_CACHE, exist_ok=True)
+        # Stream and extract the TAR archive
+        download_weights(weights_url, local_weights_cache)
+        with open(etag_path, "w") as f:
+            f.write(etag or "")
+
+        # Evict the least recently used archives
+        cached = sorted(
+            (os.path.join(LORA_CACHE, d) for d in os.listdir(LORA_CACHE)),
+            key=os.path.getmtime,
+        )
+        for path in cached[:-LORA_CACHE_SIZE]:
+            shutil.rmtree(path, ignore_errors=True)
+
+        return local_weights_cache
+
+    def merge_lora(self, lora_scale):
+        print(f"Merging Unet LoRA with scale {lora_scale}")
+        # W' = W + scale * up @ down, so the LoRA costs nothing per step.
+        # Written in place into the (fused) weight rows, so the compiled Unet
+        # keeps its modules and parameters and doesn't recompile
+        for lora in self.lora_layers.values():
+            weight = lora["linear"].weight
+            rows = lora["rows"]
+            base = self.base_unet_params[lora["weight_name"]][rows]
+            base = base.to(weight.device).float()
+            delta = lora["up"].float() @ lora["down"].float()
+            weight.data[rows].copy_(base + lora_scale * delta)
+
+        self.lora_scale = lora_scale
+
+    def save_base_unet_params(self, sd, keys):
+        # keep a CPU copy of every param a fine-tune overwrites, once
+        for k in keys:
+            if k in sd and k not in self.base_unet_params:
+                self.base_unet_params[k] = sd[k].to("cpu", copy=True)
+
+    def unload_trained_weights(self, pipe):
+        # also undoes a load that failed part way
+        print("Restoring base Unet")
+        unet = pipe.unet._orig_mod if is_compiled_module(pipe.unet) else pipe.unet
+        unet.load_state_dict(self.base_unet_params, strict=False)
+        refresh_fused_projections(unet)
+
+        self.lora_layers = {}
+        self.lora_scale = None
+        self.tuned_model = False
+
     def setup(self, weights: Optional[Path] = None):
         """Load the model into memory to make running multiple predictions efficient"""
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+        # Only dispatch SDPA to the fused flash / memory-efficient kernels,
+        # never the math path that materializes the full attention matrix
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        torch.backends.cuda.enable_math_sdp(False)
+
         start = time.time()
         self.tuned_model = False
+        self.is_lora = False
+        self.lora_url = None
+        self.lora_scale = None
+        self.lora_layers = {}
+        self.base_unet_params = {}
+        self.prompt_cache = OrderedDict()
+        self.generator = torch.Generator("cuda")
+        self.upload_stream = torch.cuda.Stream()
+
+        print("Loading ssd txt2img pipeline...")
+        self.txt2img_pipe = StableDiffusionXLPipeline.from_pretrained(
+            MODEL_CACHE,
+            torch_dtype=torch.float16,
+            use_safetensors=True,
+        )
+        self.txt2img_pipe.to("cuda")
+
+        self.txt2img_pipe.fuse_qkv_projections()
+
+        if QUANTIZE_UNET:
+            print("Quantizing Unet...")
+            torch._inductor.config.force_fuse_int_mm_with_mul = True
+            torch._inductor.config.use_mixed_mm = True
+            swap_conv2d_1x1_to_linear(self.txt2img_pipe.unet, conv_filter_fn)
+            apply_dynamic_quant(self.txt2img_pipe.unet, dynamic_quant_filter_fn)
+
+        print("Compiling Unet and VAE decoder...")
+        torch._inductor.config.conv_1x1_as_mm = True
+        torch._inductor.config.epilogue_fusion = False
+        torch._inductor.config.coordinate_descent_tuning = True
+        self.txt2img_pipe.unet.to(memory_format=torch.channels_last)
+        self.txt2img_pipe.vae.to(memory_format=torch.channels_last)
+        self.txt2img_pipe.unet = torch.compile(
+            self.txt2img_pipe.unet, mode="reduce-overhead", fullgraph=True
+        )
+        self.txt2img_pipe.vae.decode = torch.compile(
+            self.txt2img_pipe.vae.decode, mode="reduce-overhead", fullgraph=True
+        )
+
+        print("Loading SDXL img2img pipeline...")
+        self.img2img_pipe = StableDiffusionXLImg2ImgPipeline(
+            vae=self.txt2img_pipe.vae,
+            text_encoder=self.txt2img_pipe.text_encoder,
+            text_encoder_2=self.txt2img_pipe.text_encoder_2,
+            tokenizer=self.txt2img_pipe.tokenizer,
+            tokenizer_2=self.txt2img_pipe.tokenizer_2,
+            unet=self.txt2img_pipe.unet,
+            scheduler=self.txt2img_pipe.scheduler,
+        )
+        self.img2img_pipe.to("cuda")
+
+        print("Loading SDXL inpaint pipeline...")
+        self.inpaint_pipe = StableDiffusionXLInpaintPipeline(
+            vae=self.txt2img_pipe.vae,
+            text_encoder=self.txt2img_pipe.text_encoder,
+            text_encoder_2=self.txt2img_pipe.text_encoder_2,
+            tokenizer=self.txt2img_pipe.tokenizer,
+            tokenizer_2=self.txt2img_pipe.tokenizer_2,
+            unet=self.txt2img_pipe.unet,
+            scheduler=self.txt2img_pipe.scheduler,
+        )
+        self.inpaint_pipe.to("cuda")
+
+        # loaded by load_refiner() on the first request that refines
+        self.refiner = None
+
+        # Watermarking is switched on per request by predict()
+        self.watermarker = self.txt2img_pipe.watermark
+        for p in [self.txt2img_pipe, self.img2img_pipe, self.inpaint_pipe]:
+            p.watermark = None
+
+        self.warmup()
+
         print("setup took: ", time.time() - start)
         # self.txt2img_pipe.__class__.encode_prompt = new_encode_prompt
 
-    def load_image(self, path):
-        # Copy the image to a temporary location
-        shutil.copyfile(path, "/tmp/image.png")
-        # Open the copied image
-        img = Image.open("/tmp/image.png")
-        # Calculate the new dimensions while maintaining aspect ratio
+    def load_refiner(self):
+        if self.refiner is not None:
+            return self.refiner
+
+        print("Loading refiner pipeline...")
+        start = time.time()
+        self.refiner = DiffusionPipeline.from_pretrained(
+            "refiner-cache",
+            text_encoder_2=self.txt2img_pipe.text_encoder_2,
+            vae=self.txt2img_pipe.vae,
+            torch_dtype=torch.float16,
+            use_safetensors=True,
+            variant="fp16",
+        )
+        self.refiner.to("cuda")
+        self.refiner.watermark = None
+        self.refiner.unet.to(memory_format=torch.channels_last)
+        # the VAE is shared and already fused
+        self.refiner.fuse_qkv_projections(vae=False)
+        self.refiner.unet = torch.compile(
+            self.refiner.unet, mode="reduce-overhead", fullgraph=True
+        )
+        print("loading refiner took: ", time.time() - start)
+        return self.refiner
+
+    def encode_prompt(self, pipe, prompt, negative_prompt):
+        # LRU of text encoder outputs for a single image, the pipe repeats
+        # them for num_images_per_prompt. The refiner only has text_encoder_2
+        # so its embeddings are cached separately
+        key = (pipe is self.refiner, prompt, negative_prompt)
+        if key in self.prompt_cache:
+            self.prompt_cache.move_to_end(key)
+        else:
+            self.prompt_cache[key] = pipe.encode_prompt(
+                prompt=prompt,
+                device="cuda",
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=negative_prompt,
+            )
+            if len(self.prompt_cache) > PROMPT_CACHE_SIZE:
+                self.prompt_cache.popitem(last=False)
+
+        (
+            prompt_embeds,
+            negative_prompt_embeds,
+            pooled_prompt_embeds,
+            negative_pooled_prompt_embeds,
+        ) = self.prompt_cache[key]
+        return {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_prompt_embeds,
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+        }
+
+    @torch.inference_mode()
+    def warmup(self):
+        # Compile and capture CUDA graphs up front so requests replay them.
+        # This stays valid once a LoRA is loaded: trained weights are written
+        # into the existing (fused) params in place, the modules never change
+        start = time.time()
+        for width, height, num_outputs in WARMUP_SHAPES:
+            print(f"Warming up {width}x{height}, {num_outputs} output(s)...")
+            self.txt2img_pipe(
+                prompt=[""] * num_outputs,
+                width=width,
+                height=height,
+                num_inference_steps=2,
+                # also compile the unguided batch size
+                callback_on_step_end=truncate_cfg(0.5),
+                callback_on_step_end_tensor_inputs=CFG_TENSOR_INPUTS,
+            )
+        print("warmup took: ", time.time() - start)
+
+    def load_image(self, path, mode="RGB"):
+        # Returns a [1, C, H, W] tensor in [0, 1] on the GPU, which the
+        # pipelines accept directly
+        img = Image.open(path).convert(mode)
+        arr = np.array(img).reshape(img.height, img.width, -1)
+        # Snap to a size bucket, the output is fitted back afterwards
         width, height = img.size
-        new_width = math.ceil(width / 64) * 64
-        new_height = math.ceil(height / 64) * 64
-        # Resize the image if needed
-        if new_width != width or new_height != height:
-            img = img.resize((new_width, new_height), Image.ANTIALIAS)
+        new_width, new_height = _bucket(width, height)
+
+        # Upload from pinned memory on a side stream so the copy overlaps the
+        # host-side setup, predict() syncs the streams before denoising
+        with torch.cuda.stream(self.upload_stream):
+            image = torch.from_numpy(arr).pin_memory()
+            image = image.to("cuda", non_blocking=True)
+            image = image.permute(2, 0, 1).unsqueeze(0).float() / 255
+            # Resize on the GPU rather than with PIL on the CPU
+            if new_width != width or new_height != height:
+                image = F.interpolate(
+                    image,
+                    size=(new_height, new_width),
+                    mode="bilinear",
+                    antialias=True,
+                )
+        # the memory is allocated on the side stream but used on the main one
+        image.record_stream(torch.cuda.current_stream())
 
-        # Convert the image to RGB mode
-        img = img.convert("RGB")
-        return img
+        return image
 
     @torch.inference_mode()
     def predict(
@@ -222,12 +638,23 @@ class Predictor(BasePredictor):
             choices=SCHEDULERS.keys(),
             default="DPMSolverMultistep",
         ),
+        sampling_mode: str = Input(
+            description="standard uses the scheduler and number of steps above. lcm switches to the LCM scheduler with 4 steps and no guidance, which is several times faster but only gives good images with an LCM-distilled LoRA",
+            choices=["standard", "lcm"],
+            default="standard",
+        ),
         num_inference_steps: int = Input(
-            description="Number of denoising steps", ge=1, le=500, default=50
+            description="Number of denoising steps", ge=1, le=500, default=25
         ),
         guidance_scale: float = Input(
             description="Scale for classifier-free guidance", ge=1, le=50, default=7.5
         ),
+        guidance_end: float = Input(
+            description="Fraction of the denoising steps that use classifier-free guidance, later steps skip the negative prompt and run about twice as fast. 1.0 guides every step",
+            ge=0.0,
+            le=1.0,
+            default=0.16,
+        ),
         prompt_strength: float = Input(
             description="Prompt strength when using img2img / inpaint. 1.0 corresponds to full destruction of information in image",
             ge=0.0,
@@ -238,7 +665,7 @@ class Predictor(BasePredictor):
             description="Random seed. Leave blank to randomize the seed", default=None
         ),
         refine: str = Input(
-            description="Which refine style to use",
+            description="Which refine style to use. no_refiner is fastest and, with guidance_end and the default steps, close in quality; the refiner is loaded and compiled on first use, so that request is slower",
             choices=["no_refiner", "expert_ensemble_refiner",
                      "base_image_refiner"],
             default="no_refiner",
@@ -263,6 +690,17 @@ class Predictor(BasePredictor):
             le=1.0,
             default=0.6,
         ),
+        output_format: str = Input(
+            description="Format of the output images",
+            choices=["png", "webp", "jpg"],
+            default="png",
+        ),
+        output_quality: int = Input(
+            description="Quality when saving webp or jpg outputs, from 1 to 100. Ignored for png",
+            ge=1,
+            le=100,
+            default=92,
+        ),
     ) -> List[Path]:
         # Check if there is a lora_url
         if lora_url == None:
@@ -270,103 +708,14 @@ class Predictor(BasePredictor):
                 f"Missing Lora_url parameter"
             )
 
-        lora = True
-        if lora == True:
-            self.is_lora = True
-            print("LORA")
-            print("Loading ssd txt2img pipeline...")
-            self.txt2img_pipe = StableDiffusionXLPipeline.from_pretrained(
-                MODEL_CACHE,
-                torch_dtype=torch.float16,
-                use_safetensors=True,
-            )
+        if lora_url != self.lora_url:
             print("Loading ssd lora weights...")
+            self.lora_url = None
             self.load_trained_weights(lora_url, self.txt2img_pipe)
-            self.txt2img_pipe.to("cuda")
-            self.is_lora = True
-
-            print("Loading SDXL img2img pipeline...")
-            self.img2img_pipe = StableDiffusionXLImg2ImgPipeline(
-                vae=self.txt2img_pipe.vae,
-                text_encoder=self.txt2img_pipe.text_encoder,
-                text_encoder_2=self.txt2img_pipe.text_encoder_2,
-                tokenizer=self.txt2img_pipe.tokenizer,
-                tokenizer_2=self.txt2img_pipe.tokenizer_2,
-                unet=self.txt2img_pipe.unet,
-                scheduler=self.txt2img_pipe.scheduler,
-            )
-            self.img2img_pipe.to("cuda")
-
-            print("Loading SDXL inpaint pipeline...")
-            self.inpaint_pipe = StableDiffusionXLInpaintPipeline(
-                vae=self.txt2img_pipe.vae,
-                text_encoder=self.txt2img_pipe.text_encoder,
-                text_encoder_2=self.txt2img_pipe.text_encoder_2,
-                tokenizer=self.txt2img_pipe.tokenizer,
-                tokenizer_2=self.txt2img_pipe.tokenizer_2,
-                unet=self.txt2img_pipe.unet,
-                scheduler=self.txt2img_pipe.scheduler,
-            )
-            self.inpaint_pipe.to("cuda")
-
-            print("Loading SDXL refiner pipeline...")
-
-            print("Loading refiner pipeline...")
-            self.refiner = DiffusionPipeline.from_pretrained(
-                "refiner-cache",
-                text_encoder_2=self.txt2img_pipe.text_encoder_2,
-                vae=self.txt2img_pipe.vae,
-                torch_dtype=torch.float16,
-                use_safetensors=True,
-                variant="fp16",
-            )
-            self.refiner.to("cuda")
-
-        else:
-            print("Loading sdxl txt2img pipeline...")
-            self.txt2img_pipe = DiffusionPipeline.from_pretrained(
-                MODEL_CACHE,
-                torch_dtype=torch.float16,
-                use_safetensors=True,
-                variant="fp16",
-            )
-            self.is_lora = False
-
-            self.txt2img_pipe.to("cuda")
-
-            # print("Loading SDXL img2img pipeline...")
-            # self.img2img_pipe = StableDiffusionXLImg2ImgPipeline(
-            #     vae=self.txt2img_pipe.vae,
-            #     text_encoder=self.txt2img_pipe.text_encoder,
-            #     text_encoder_2=self.txt2img_pipe.text_encoder_2,
-            #     tokenizer=self.txt2img_pipe.tokenizer,
-            #     tokenizer_2=self.txt2img_pipe.tokenizer_2,
-            #     unet=self.txt2img_pipe.unet,
-            #     scheduler=self.txt2img_pipe.scheduler,
-            # )
-            # self.img2img_pipe.to("cuda")
-
-            # print("Loading SDXL inpaint pipeline...")
-            # self.inpaint_pipe = StableDiffusionXLInpaintPipeline(
-            #     vae=self.txt2img_pipe.vae,
-            #     text_encoder=self.txt2img_pipe.text_encoder,
-            #     text_encoder_2=self.txt2img_pipe.text_encoder_2,
-            #     tokenizer=self.txt2img_pipe.tokenizer,
-            #     tokenizer_2=self.txt2img_pipe.tokenizer_2,
-            #     unet=self.txt2img_pipe.unet,
-            #     scheduler=self.txt2img_pipe.scheduler,
-            # )
-            # self.inpaint_pipe.to("cuda")
-            # print("Loading refiner pipeline...")
-            # self.refiner = DiffusionPipeline.from_pretrained(
-            #     "refiner-cache",
-            #     text_encoder_2=self.txt2img_pipe.text_encoder_2,
-            #     vae=self.txt2img_pipe.vae,
-            #     torch_dtype=torch.float16,
-            #     use_safetensors=True,
-            #     variant="fp16",
-            # )
-            # self.refiner.to("cuda")
+            self.lora_url = lora_url
+        # the LoRA is merged into the Unet at a fixed scale
+        if self.is_lora and lora_scale != self.lora_scale:
+            self.merge_lora(lora_scale)
 
         """Run a single prediction on the model"""
         if seed is None:
@@ -381,27 +730,32 @@ class Predictor(BasePredictor):
         print(f"Prompt: {prompt}")
         if image and mask:
             print("inpainting mode")
+            output_size = Image.open(image).size
             loaded_image = self.load_image(image)
             sdxl_kwargs["image"] = loaded_image
-            sdxl_kwargs["mask_image"] = self.load_image(mask)
+            sdxl_kwargs["mask_image"] = self.load_image(mask, mode="L")
             sdxl_kwargs["strength"] = prompt_strength
 
             # Get the dimensions (height and width) of the loaded image
-            image_width, image_height = loaded_image.size
+            image_height, image_width = loaded_image.shape[-2:]
 
             sdxl_kwargs["target_size"] = (image_width, image_height)
             sdxl_kwargs["original_size"] = (image_width, image_height)
+            # otherwise the inpaint pipe falls back to 1024x1024
+            sdxl_kwargs["width"] = image_width
+            sdxl_kwargs["height"] = image_height
 
             pipe = self.inpaint_pipe
         elif image:
             print("img2img mode")
+            output_size = Image.open(image).size
             sdxl_kwargs["image"] = self.load_image(image)
             sdxl_kwargs["strength"] = prompt_strength
             pipe = self.img2img_pipe
         else:
             print("txt2img mode")
-            sdxl_kwargs["width"] = width
-            sdxl_kwargs["height"] = height
+            output_size = (width, height)
+            sdxl_kwargs["width"], sdxl_kwargs["height"] = _bucket(width, height)
             pipe = self.txt2img_pipe
 
         if refine == "expert_ensemble_refiner":
@@ -410,48 +764,93 @@ class Predictor(BasePredictor):
         elif refine == "base_image_refiner":
             sdxl_kwargs["output_type"] = "latent"
 
-         # toggles watermark for this prediction
-        if not apply_watermark:
-            watermark_cache = pipe.watermark
-            pipe.watermark = None
+        if sampling_mode == "lcm":
+            scheduler = "LCM"
+            num_inference_steps = LCM_STEPS
+            guidance_scale = 1.0
 
         pipe.scheduler = SCHEDULERS[scheduler].from_config(
             pipe.scheduler.config)
-        generator = torch.Generator("cuda").manual_seed(seed)
-
+        generator = self.generator.manual_seed(seed)
+
+        sdxl_kwargs["callback_on_step_end"] = truncate_cfg(guidance_end)
+        sdxl_kwargs["callback_on_step_end_tensor_inputs"] = CFG_TENSOR_INPUTS
+        if pipe is self.inpaint_pipe:
+            # the inpaint mask is batched for guidance too
+            sdxl_kwargs["callback_on_step_end_tensor_inputs"] = CFG_TENSOR_INPUTS + [
+                "mask"
+            ]
+
+        # pad the batch up to a bucket, extra images are dropped below
+        batch_size = _bucket_batch(num_outputs)
+        sdxl_kwargs.update(self.encode_prompt(pipe, prompt, negative_prompt))
+        sdxl_kwargs["num_inference_steps"] = num_inference_steps
+        sdxl_kwargs["guidance_scale"] = guidance_scale
+        # steps the base pass runs, as diffusers counts them
+        base_steps = num_inference_steps
+        if image:
+            base_steps = min(int(num_inference_steps * prompt_strength), base_steps)
+        if refine == "expert_ensemble_refiner":
+            base_steps = int(base_steps * high_noise_frac)
+        if cfg_cutoff(guidance_end, base_steps) < 0:
+            # truncate_cfg would never fire, so don't batch the negative pass
+            sdxl_kwargs["guidance_scale"] = 1.0
         common_args = {
-            "prompt": [prompt] * num_outputs,
-            "negative_prompt": [negative_prompt] * num_outputs,
-            "guidance_scale": guidance_scale,
             "generator": generator,
-            "num_inference_steps": num_inference_steps,
+            "num_images_per_prompt": batch_size,
         }
 
-        if self.is_lora:
-            sdxl_kwargs["cross_attention_kwargs"] = {"scale": lora_scale}
-
-        output = pipe(**common_args, **sdxl_kwargs)
-
-        if refine in ["expert_ensemble_refiner", "base_image_refiner"]:
-            refiner_kwargs = {
-                "image": output.images,
-            }
-
-            if refine == "expert_ensemble_refiner":
-                refiner_kwargs["denoising_start"] = high_noise_frac
-            if refine == "base_image_refiner" and refine_steps:
-                common_args["num_inference_steps"] = refine_steps
-
-            output = self.refiner(**common_args, **refiner_kwargs)
-
-        output_paths = []
-        for i, _ in enumerate(output.images):
-            # if nsfw:
-            #     print(f"NSFW content detected in image {i}")
-            #     continue
-            output_path = f"/tmp/out-{i}.png"
-            output.images[i].save(output_path)
-            output_paths.append(Path(output_path))
+        # only the pipe that decodes the final images embeds the watermark
+        final_pipe = pipe if refine == "no_refiner" else self.load_refiner()
+        if apply_watermark:
+            final_pipe.watermark = self.watermarker
+        try:
+            torch.cuda.current_stream().wait_stream(self.upload_stream)
+            output = pipe(**common_args, **sdxl_kwargs)
+
+            if refine in ["expert_ensemble_refiner", "base_image_refiner"]:
+                refiner_kwargs = {
+                    "image": output.images,
+                    "num_inference_steps": num_inference_steps,
+                    "guidance_scale": guidance_scale,
+                    **self.encode_prompt(self.refiner, prompt, negative_prompt),
+                }
+
+                if refine == "expert_ensemble_refiner":
+                    # same schedule, picking up where the base stopped
+                    refiner_kwargs["denoising_start"] = high_noise_frac
+                if refine == "base_image_refiner" and refine_steps:
+                    refiner_kwargs["num_inference_steps"] = refine_steps
+
+                output = self.refiner(**common_args, **refiner_kwargs)
+        finally:
+            final_pipe.watermark = None
+
+        # img2img / inpaint inputs were stretched to the bucket, so undo the
+        # stretch; txt2img crops to the requested aspect ratio instead
+        if image:
+            fit = lambda img: img.resize(output_size, Image.Resampling.LANCZOS)
+        else:
+            fit = lambda img: ImageOps.fit(
+                img, output_size, method=Image.Resampling.LANCZOS
+            )
+        output.images = [
+            img if img.size == output_size else fit(img)
+            for img in output.images[:num_outputs]
+        ]
+
+        output_paths = [
+            Path(f"/tmp/out-{i}.{output_format}") for i in range(len(output.images))
+        ]
+        # PIL releases the GIL while encoding, so the outputs encode in parallel
+        with ThreadPoolExecutor(max_workers=max(len(output_paths), 1)) as executor:
+            list(
+                executor.map(
+                    lambda img, path: save_image(img, str(path), output_quality),
+                    output.images,
+                    output_paths,
+                )
+            )
 
         if len(output_paths) == 0:
             raise Exception(